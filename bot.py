@@ -17,10 +17,27 @@ import pandas as pd
 import pytz
 import requests
 from jinja2 import Template
-from telegram import InputMediaPhoto, Update
-from telegram.ext import CallbackContext, CommandHandler, Updater
-
-from fetch import get_population, get_vaccines_data, load_df, regions
+from telegram import (
+    InlineQueryResultArticle,
+    InputMediaPhoto,
+    InputTextMessageContent,
+    Update,
+)
+from telegram.ext import CallbackContext, CommandHandler, InlineQueryHandler, Updater
+
+from fetch import (
+    Archive,
+    data_version,
+    find_region,
+    find_regions,
+    get_population,
+    get_region_data,
+    get_vaccines_data,
+    italy,
+    load_df,
+    regions,
+    unknown_words,
+)
 
 if os.environ.get("WITH_AWS", None):
     session = boto3.Session(
@@ -50,6 +67,8 @@ pop_src = "https://www.worldometers.info/world-population/italy-population/"
 pop_exp = r"The current population of <strong>Italy</strong> is <strong>(.*?)</strong>"
 pop_pattern = re.compile(pop_exp)
 
+archive = Archive()
+
 
 def send_to_S3(filename):
     # Filename - File to upload
@@ -81,7 +100,9 @@ about COVID vaccinations in Italy with the command <b>/latest</b>. \
 Subscribe to get daily updates: \
 <b>/subscribe</b>. Or <b>/unsubscribe</b>.\n \
 <b>/plot</b> to see a chart of vaccinations for Italy, \
-or <b>/plot regione</b> for info region by region. Example: /plot Liguria",
+or <b>/plot regione</b> for info region by region. Example: /plot Liguria\n \
+<b>/history regione da a</b> for the doses in a past period. \
+Example: /history Lombardia 2021-03",
         parse_mode="HTML",
     )
 
@@ -132,21 +153,15 @@ def plot(update: Update, context: CallbackContext) -> None:
     ts = dt.now().strftime("%Y%m%d-%H%M")
 
     if context.args:
-        found = False
-        for abbr, name in regions.items():
-            for arg in context.args:
-                if arg.lower() in (_n.lower() for _n in name):
-                    region_name = name[0]
-                    region_abbr = abbr
-                    found = True
-        if not found:
+        region_abbr = find_region(context.args)
+        if region_abbr is None:
             update.message.reply_text("Regione inesistente.")
             return
     else:
-        region_name = "Italy"
         region_abbr = "ITA"
+    region_name = {**italy, **regions}[region_abbr][0]
 
-    if region_name == "Italy":
+    if region_abbr == "ITA":
         plot_urls = [
             f"https://mttmantovani.s3.eu-central-1.amazonaws.com/charts/latest-{plot}.png?a={ts}"
             for plot in ["total", "daily", "map"]
@@ -164,6 +179,161 @@ def plot(update: Update, context: CallbackContext) -> None:
     update.message.reply_media_group(plots)
 
 
+def parse_period(text):
+    # "2021-03-15" is a single day, "2021-03" a whole month, "2021" a whole year
+    for fmt in ("%Y-%m-%d", "%Y-%m", "%Y"):
+        try:
+            start = dt.strptime(text, fmt).date()
+        except ValueError:
+            continue
+        if fmt == "%Y-%m-%d":
+            end = start
+        elif fmt == "%Y-%m":
+            end = (start + td(days=32)).replace(day=1) - td(days=1)
+        else:
+            end = start.replace(month=12, day=31)
+        return start, end
+    return None
+
+
+def history(update: Update, context: CallbackContext) -> None:
+    args = list(context.args)
+    periods = []
+    while args and len(periods) < 2 and parse_period(args[-1]):
+        periods.insert(0, parse_period(args.pop()))
+
+    usage = (
+        "Uso: /history [regione] [da] [a], con date come 2021-03-15, 2021-03 o 2021. "
+        "Esempio: /history Lombardia 2021-03 2021-04"
+    )
+
+    if args:
+        region_abbr = find_region(args)
+        if region_abbr is None:
+            update.message.reply_text(usage)
+            return
+        unknown = unknown_words(args, region_abbr)
+        if unknown:
+            update.message.reply_text(f"Argomento non valido: {unknown[0]}. {usage}")
+            return
+    else:
+        region_abbr = "ITA"
+
+    if periods:
+        start, end = periods[0][0], periods[-1][1]
+        if start > end:
+            update.message.reply_text(
+                f"La data iniziale {start} è successiva a quella finale {end}."
+            )
+            return
+    else:
+        start, end = None, None
+
+    # sync_archive rewrites the arrays from another thread
+    with archive.lock:
+        days = archive.days
+        if days:
+            first, last = archive.start, archive.end
+            start, end = max(start or first, first), min(end or last, last)
+            if start <= end:
+                data = archive.totals(region_abbr, start, end)
+                peak_date, peak_avg = archive.peak_average(region_abbr, 7, start, end)
+
+    if not days:
+        update.message.reply_text("Archivio non ancora disponibile, riprova più tardi.")
+        return
+    if start > end:
+        update.message.reply_text(f"Dati disponibili dal {first} al {last}. {usage}")
+        return
+
+    with codecs.open("template-history.html", "r", encoding="UTF-8") as file:
+        template = Template(file.read())
+        update.message.reply_text(
+            template.render(
+                region={**italy, **regions}[region_abbr][0],
+                start=start,
+                end=end,
+                avg_doses=data["totale"] / ((end - start).days + 1),
+                peak_date=peak_date,
+                peak_avg=peak_avg,
+                **data,
+            ),
+            parse_mode="HTML",
+        )
+
+
+# Inline answers for Italy and every region, rebuilt only when upstream data
+# or the charts uploaded by fetch.py change
+inline_version = None
+inline_results = {}
+
+
+def chart_tag(url):
+    # The ETag changes with every upload, unlike the data version
+    r = requests.head(url)
+    return r.headers.get("ETag", "").strip('"')
+
+
+def refresh_inline_results(context):
+    global inline_version, inline_results
+
+    chart_urls = {
+        abbr: f"https://mttmantovani.s3.eu-central-1.amazonaws.com/charts/regions/{abbr.lower()}-total.png"
+        for abbr in regions
+    }
+    chart_urls["ITA"] = (
+        "https://mttmantovani.s3.eu-central-1.amazonaws.com/charts/latest-total.png"
+    )
+
+    df = load_df()
+    version = data_version(df)
+    tags = {abbr: chart_tag(url) for abbr, url in chart_urls.items()}
+    if (version, tags) == inline_version:
+        return
+
+    date_wordy = dt.now().strftime("%b %-d, %Y - %H:%M")
+    with codecs.open("template.html", "r", encoding="UTF-8") as file:
+        template = Template(file.read())
+    with codecs.open("template-region.html", "r", encoding="UTF-8") as file:
+        template_region = Template(file.read())
+
+    results = {}
+    for abbr, names in {**italy, **regions}.items():
+        if abbr == "ITA":
+            data = get_vaccines_data(df)
+            text = template.render(date=date_wordy, **data)
+        else:
+            data = get_region_data(df, abbr)
+            text = template_region.render(date=date_wordy, **data)
+        chart_url = f"{chart_urls[abbr]}?a={tags[abbr]}"
+
+        # Zero-width link so that the chart shows up as the message preview
+        results[abbr] = InlineQueryResultArticle(
+            id=f"{abbr}-{version}-{tags[abbr][:8]}",
+            title=names[0],
+            description=f"Total doses: {data['total_doses']:,.0f}",
+            thumb_url=chart_url,
+            input_message_content=InputTextMessageContent(
+                f'<a href="{chart_url}">\u200b</a>' + text, parse_mode="HTML"
+            ),
+        )
+
+    inline_version, inline_results = (version, tags), results
+    logger.info(f"Inline results refreshed to version {version}")
+
+
+def sync_archive(context):
+    # Local only: fetch.py main() is the one uploading the archive to S3
+    archive.sync(load_df())
+
+
+def inline_query(update: Update, context: CallbackContext) -> None:
+    query = update.inline_query.query
+    abbrs = find_regions(query) if query.strip() else ["ITA"]
+    results = [inline_results[abbr] for abbr in abbrs if abbr in inline_results]
+    update.inline_query.answer(results, cache_time=300)
+
+
 def is_subscribed(name, context):
     current_jobs = context.job_queue.get_jobs_by_name(name)
     if not current_jobs:
@@ -244,6 +414,9 @@ def main():
         subscribed_users = []
         times = []
 
+    if os.environ.get("WITH_AWS", None):
+        archive.download()
+
     for user in subscribed_users:
         updater.job_queue.run_daily(
             latest_job,
@@ -253,16 +426,21 @@ def main():
             name=user,
         )
 
+    updater.job_queue.run_repeating(refresh_inline_results, interval=3600, first=0)
+    updater.job_queue.run_repeating(sync_archive, interval=3600, first=0)
+
     dispatcher = updater.dispatcher
 
     dispatcher.add_handler(CommandHandler("start", start))
     dispatcher.add_handler(CommandHandler("help", help_command))
     dispatcher.add_handler(CommandHandler("latest", latest))
     dispatcher.add_handler(CommandHandler("plot", plot))
+    dispatcher.add_handler(CommandHandler("history", history))
     dispatcher.add_handler(CommandHandler("subscribe", subscribe))
     dispatcher.add_handler(CommandHandler("unsubscribe", unsubscribe))
     dispatcher.add_handler(CommandHandler("goodbot", goodbot))
     dispatcher.add_handler(CommandHandler("badbot", badbot))
+    dispatcher.add_handler(InlineQueryHandler(inline_query))
 
     if os.environ.get("IS_HEROKU", None):
         updater.start_webhook(listen="0.0.0.0", port=PORT, url_path=token)
@@ -1,9 +1,11 @@
 import io
+import json
 import os
 import re
 import shutil
+import threading
+import unicodedata
 import zipfile
-from datetime import date
 from datetime import datetime as dt
 from datetime import timedelta as td
 
@@ -80,6 +82,300 @@ regions = {
     "VEN": ["Veneto"],
 }
 
+italy = {"ITA": ["Italy", "Italia"]}
+
+
+def normalize(text):
+    # Lowercase, drop accents, spaces and punctuation: "Vallée d'Aoste" -> "valleedaoste"
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if c.isalnum())
+
+
+def build_region_index():
+    # Map every normalized alias (and every prefix of it) to the matching areas
+    aliases = {}
+    prefixes = {}
+    for abbr, names in {**italy, **regions}.items():
+        for name in [abbr] + names:
+            key = normalize(name)
+            if abbr not in aliases.setdefault(key, []):
+                aliases[key].append(abbr)
+            for i in range(1, len(key) + 1):
+                if abbr not in prefixes.setdefault(key[:i], []):
+                    prefixes[key[:i]].append(abbr)
+    return aliases, prefixes
+
+
+region_aliases, region_prefixes = build_region_index()
+
+
+def match_regions(words):
+    # Areas matching most of the given words, e.g. "provincia autonoma Trento"
+    votes = {}
+    for word in words:
+        # "Friuli-Venezia" is no alias, but both its halves are
+        pieces = (
+            [word] if normalize(word) in region_aliases else re.split(r"[-']", word)
+        )
+        for abbr in dict.fromkeys(
+            a for p in pieces for a in region_aliases.get(normalize(p), [])
+        ):
+            votes[abbr] = votes.get(abbr, 0) + 1
+    best = max(votes.values(), default=0)
+    return [abbr for abbr, count in votes.items() if count == best]
+
+
+def find_region(words):
+    # Ambiguous words such as "provincia autonoma" match no single area
+    matches = match_regions(words)
+    return matches[0] if len(matches) == 1 else None
+
+
+def unknown_words(words, abbr):
+    # Words that are not part of the name of `abbr`: "2021-13" or "marzo", but
+    # neither "Friuli-Venezia" nor the "di" of "provincia autonoma di Trento"
+    def known(word):
+        return normalize(word) == "di" or abbr in region_aliases.get(
+            normalize(word), []
+        )
+
+    if known("".join(words)):
+        return []
+    return [
+        word
+        for word in words
+        if not known(word)
+        and not all(known(piece) for piece in re.split(r"[-']", word) if piece)
+    ]
+
+
+def find_regions(query):
+    # All areas whose name starts with the query, falling back to word matching
+    return region_prefixes.get(normalize(query), []) or match_regions(query.split())
+
+
+archive_areas = list(regions) + ["ITA"]
+archive_doses = ["prima_dose", "seconda_dose", "dose_addizionale_booster", "totale"]
+# Upstream keeps revising recent days for a while, as regions upload late
+archive_settle_days = 14
+
+
+class Archive:
+    """Daily archive of doses per area, memory-mapped from disk.
+
+    Two int64 arrays are kept side by side: the daily counts, with shape
+    (days, areas, doses), and their cumulative sums along the days, with a
+    leading row of zeros. The total over any range of days is then the
+    difference of two rows of the cumulative sums.
+
+    New days are appended, and the last `archive_settle_days` are rewritten
+    from upstream whenever its data version changes, so that late uploads are
+    picked up. fetch.py main() is the only process uploading it to S3.
+    """
+
+    def __init__(self, path="archive"):
+        self.path = path
+        self.meta_file = os.path.join(path, "meta.json")
+        self.daily_file = os.path.join(path, "daily.bin")
+        self.cumsum_file = os.path.join(path, "cumsum.bin")
+        # meta.json last, as it tells how much of the other files is valid
+        self.files = [self.daily_file, self.cumsum_file, self.meta_file]
+        # Held while the arrays change; readers in other threads take it too
+        self.lock = threading.Lock()
+        self.start = None
+        self.days = 0
+        self.version = None
+        self.daily = None
+        self.cumsum = None
+        self.load()
+
+    def load(self):
+        with self.lock:
+            self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.meta_file):
+            return
+        with open(self.meta_file, "r") as meta:
+            meta = json.load(meta)
+
+        row = np.dtype(np.int64).itemsize * len(archive_areas) * len(archive_doses)
+        for filename, rows in (
+            (self.daily_file, meta["days"]),
+            (self.cumsum_file, meta["days"] + 1),
+        ):
+            if not os.path.isfile(filename) or os.path.getsize(filename) < row * rows:
+                print("The archive is incomplete, it will be rebuilt.")
+                return
+
+        self.start = dt.strptime(meta["start"], "%Y-%m-%d").date()
+        self.version = meta.get("version")
+        self._open(meta["days"])
+
+    def download(self):
+        """Restore the archive saved by upload()."""
+
+        os.makedirs(self.path, exist_ok=True)
+        get_from_S3(self.meta_file, self.meta_file)
+        if os.path.isfile(self.meta_file):
+            for filename in self.files[:-1]:
+                get_from_S3(filename, filename)
+        self.load()
+
+    def upload(self):
+        for filename in self.files:
+            send_to_S3(filename, filename)
+
+    @property
+    def end(self):
+        return self.start + td(days=self.days - 1)
+
+    def _shape(self, rows):
+        return (rows, len(archive_areas), len(archive_doses))
+
+    def _open(self, days):
+        if days:
+            self.daily = np.memmap(
+                self.daily_file, dtype=np.int64, mode="r", shape=self._shape(days)
+            )
+        self.cumsum = np.memmap(
+            self.cumsum_file, dtype=np.int64, mode="r", shape=self._shape(days + 1)
+        )
+        self.days = days
+
+    def sync(self, df):
+        """Archive the complete days of `df` (as from load_df).
+
+        Returns the number of days written, rewritten ones included, which is
+        none if upstream has not changed since the last sync.
+        """
+
+        with self.lock:
+            return self._sync(df)
+
+    def _sync(self, df):
+        version = data_version(df)
+        if version == self.version:
+            return 0
+
+        df = df.loc[df.index <= last_complete_day(df)]
+        if self.start is None:
+            keep = 0
+            first = df.index.min()
+        else:
+            keep = max(self.days - archive_settle_days, 0)
+            first = pd.Timestamp(self.start + td(days=keep))
+            df = df.loc[df.index >= first]
+        if df.empty:
+            return 0
+
+        dates = pd.date_range(first, df.index.max(), name="data_somministrazione")
+        daily = (
+            df.groupby([df.index, "area"])[archive_doses]
+            .sum()
+            .reindex(pd.MultiIndex.from_product([dates, list(regions)]), fill_value=0)
+            .to_numpy(dtype=np.int64)
+            .reshape(len(dates), len(regions), len(archive_doses))
+        )
+        daily = np.concatenate([daily, daily.sum(axis=1, keepdims=True)], axis=1)
+
+        if self.start is None:
+            os.makedirs(self.path, exist_ok=True)
+            last = np.zeros(self._shape(1), dtype=np.int64)
+            open(self.daily_file, "wb").close()
+            with open(self.cumsum_file, "wb") as f:
+                f.write(last.tobytes())
+            self.start = dates[0].date()
+        else:
+            last = np.array(self.cumsum[keep : keep + 1])
+
+        # Overwrite in place instead of truncating, so that the arrays mapped
+        # by readers stay valid; meta.json tells how many days are in use
+        row = daily[0].nbytes
+        with open(self.daily_file, "r+b") as f:
+            f.seek(row * keep)
+            f.write(daily.tobytes())
+        with open(self.cumsum_file, "r+b") as f:
+            f.seek(row * (keep + 1))
+            f.write((last + daily.cumsum(axis=0)).tobytes())
+
+        days = keep + len(dates)
+        with open(self.meta_file + ".tmp", "w") as meta:
+            json.dump(
+                {
+                    "start": self.start.strftime("%Y-%m-%d"),
+                    "days": days,
+                    "version": version,
+                },
+                meta,
+            )
+        os.replace(self.meta_file + ".tmp", self.meta_file)
+        self.version = version
+        self._open(days)
+
+        return len(dates)
+
+    def _index(self, day):
+        # Row of the cumulative sums holding everything before `day`
+        day = pd.Timestamp(day).date()
+        return min(max((day - self.start).days, 0), self.days)
+
+    def totals(self, area, start, end):
+        """Doses administered in `area` from `start` to `end`, both included."""
+
+        a = archive_areas.index(area.upper())
+        lo, hi = self._index(start), self._index(pd.Timestamp(end) + td(days=1))
+        diff = self.cumsum[hi, a] - self.cumsum[lo, a]
+        return dict(zip(archive_doses, diff.tolist()))
+
+    def total(self, area, start, end, dose="totale"):
+        return self.totals(area, start, end)[dose]
+
+    def peak_average(self, area, window=7, start=None, end=None, dose="totale"):
+        """Highest `window`-days moving average, with the last day of that window."""
+
+        a = archive_areas.index(area.upper())
+        d = archive_doses.index(dose)
+        lo = self._index(start) if start is not None else 0
+        hi = (
+            self._index(pd.Timestamp(end) + td(days=1))
+            if end is not None
+            else self.days
+        )
+        cumsum = self.cumsum[lo : hi + 1, a, d]
+        if len(cumsum) <= window:
+            return None, None
+        sums = cumsum[window:] - cumsum[:-window]
+        peak = int(sums.argmax())
+        return self.start + td(days=lo + peak + window - 1), sums[peak] / window
+
+    def frame(self, area=None):
+        """Daily doses of `area`, or of every region, in the same shape as load_df.
+
+        Unlike load_df the last day is complete: pass complete=True to the
+        chart functions.
+        """
+
+        columns = ["area", "nome_area"] + archive_doses
+        if not self.days:
+            index = pd.DatetimeIndex([], name="data_somministrazione")
+            return pd.DataFrame(columns=columns, index=index)
+
+        dates = pd.date_range(
+            self.start, periods=self.days, name="data_somministrazione"
+        )
+        frames = []
+        for abbr in [area.upper()] if area else list(regions):
+            frame = pd.DataFrame(
+                np.array(self.daily[:, archive_areas.index(abbr)]),
+                index=dates,
+                columns=archive_doses,
+            )
+            frame["area"] = abbr
+            frame["nome_area"] = {**italy, **regions}[abbr][0]
+            frames.append(frame[columns])
+        return pd.concat(frames)
+
 
 def get_population_regions():
     # Download data
@@ -160,9 +456,21 @@ def load_map():
     return italy_map
 
 
-def get_vaccines_data():
+def data_version(df):
+    # Changes whenever upstream publishes new data
+    return df.index.max().strftime("%Y%m%d") + f"-{df.totale.sum()}"
+
+
+def last_complete_day(df):
+    # The newest upstream day is still being filled in
+    return df.index.max() - td(days=1)
+
 
-    df = load_df().groupby("data_somministrazione").sum()
+def get_vaccines_data(df=None):
+
+    if df is None:
+        df = load_df()
+    df = df.groupby("data_somministrazione").sum()
 
     population = get_population()
     pop_over_12 = get_population_regions()
@@ -192,12 +500,9 @@ def get_vaccines_data():
     )
     herd_date = df.index[-1] + td(days=days_to_herd)
 
-    today = date(dt.now().year, dt.now().month, dt.now().day)
-    yesterday = today - td(days=1)
-    last_day_data = df.loc[df.index == pd.to_datetime(yesterday, format="%Y-%m-%d")]
-    previous_day_data = df.loc[
-        df.index == pd.to_datetime(yesterday - td(days=1), format="%Y-%m-%d")
-    ]
+    yesterday = last_complete_day(df)
+    last_day_data = df.loc[df.index == yesterday]
+    previous_day_data = df.loc[df.index == yesterday - td(days=1)]
 
     vaccines_data = {
         "total_doses": total_doses,
@@ -232,8 +537,31 @@ def get_vaccines_data():
     return vaccines_data
 
 
-def plot_cumulative(df):
+def get_region_data(df, region_abbr):
+
+    yesterday = last_complete_day(df)
+    df = df.loc[df["area"] == region_abbr.upper()].sort_index()
+
+    last_week_data = df.loc[df.index > yesterday - td(days=6)]
+    last_day_data = df.loc[df.index == yesterday]
 
+    region_data = {
+        "region": regions[region_abbr.upper()][0],
+        "total_doses": df.totale.sum(),
+        "total_first_dose": df.prima_dose.sum(),
+        "total_second_dose": df.seconda_dose.sum(),
+        "total_third_dose": df.dose_addizionale_booster.sum(),
+        "avg_lw_doses": last_week_data.totale.sum() / 7,
+        "y_total_doses": last_day_data.totale.sum(),
+    }
+
+    return region_data
+
+
+def plot_cumulative(df, complete=False):
+
+    # The last row of load_df is still being filled in
+    last = None if complete else -1
     df = df.groupby("data_somministrazione").sum()
 
     fig, ax = plt.subplots()
@@ -244,17 +572,19 @@ def plot_cumulative(df):
     ax.set_ylabel("Total doses")
 
     #    ax.fill_between(df.index[:-1], df.totale.cumsum()[:-1], lw=2, color="ForestGreen", label="Total")
-    ax.fill_between(df.index[:-1], df.prima_dose.cumsum()[:-1], y2=0, label="1st dose")
     ax.fill_between(
-        df.index[:-1],
-        df.prima_dose.cumsum()[:-1] + df.seconda_dose.cumsum()[:-1],
-        y2=df.prima_dose.cumsum()[:-1],
+        df.index[:last], df.prima_dose.cumsum()[:last], y2=0, label="1st dose"
+    )
+    ax.fill_between(
+        df.index[:last],
+        df.prima_dose.cumsum()[:last] + df.seconda_dose.cumsum()[:last],
+        y2=df.prima_dose.cumsum()[:last],
         label="2nd dose",
     )
     ax.fill_between(
-        df.index[:-1],
-        df.totale.cumsum()[:-1],
-        y2=df.prima_dose.cumsum()[:-1] + df.seconda_dose.cumsum()[:-1],
+        df.index[:last],
+        df.totale.cumsum()[:last],
+        y2=df.prima_dose.cumsum()[:last] + df.seconda_dose.cumsum()[:last],
         label="3rd dose",
         color="red",
     )
@@ -268,8 +598,10 @@ def plot_cumulative(df):
     plt.close()
 
 
-def plot_daily_doses(df):
+def plot_daily_doses(df, complete=False):
 
+    # The last row of load_df is still being filled in
+    last = None if complete else -1
     df = df.groupby("data_somministrazione").sum()
 
     fig, ax = plt.subplots()
@@ -280,22 +612,25 @@ def plot_daily_doses(df):
     ax.xaxis.set_major_locator(mdates.AutoDateLocator())
     ax.set_ylabel("Daily doses")
 
-    ax.bar(df.index[:-1], df.prima_dose[:-1], label="1st dose")
+    ax.bar(df.index[:last], df.prima_dose[:last], label="1st dose")
     ax.bar(
-        df.index[:-1], df.seconda_dose[:-1], bottom=df.prima_dose[:-1], label="2nd dose"
+        df.index[:last],
+        df.seconda_dose[:last],
+        bottom=df.prima_dose[:last],
+        label="2nd dose",
     )
     ax.bar(
-        df.index[:-1],
-        df.dose_addizionale_booster[:-1],
-        bottom=df.prima_dose[:-1] + df.seconda_dose[:-1],
+        df.index[:last],
+        df.dose_addizionale_booster[:last],
+        bottom=df.prima_dose[:last] + df.seconda_dose[:last],
         label="3rd dose",
         color="red",
     )
 
     ax.plot(
-        df.index[:-1],
+        df.index[:last],
         # (df.prima_dose + df.seconda_dose + df.dose_addizionale_booster)
-        df.totale.rolling(window=7, min_periods=1, center=True).mean()[:-1],
+        df.totale.rolling(window=7, min_periods=1, center=True).mean()[:last],
         lw=2,
         color="ForestGreen",
         label="Total (7-days moving average)",
@@ -331,8 +666,9 @@ def plot_map(df):
     plt.close()
 
 
-def plot_region(df, region_abbr):
+def plot_region(df, region_abbr, complete=False):
 
+    last = None if complete else -1
     df = df.loc[df["area"] == region_abbr.upper()].sort_index()
 
     region = df["nome_area"][0]
@@ -345,13 +681,16 @@ def plot_region(df, region_abbr):
     ax.xaxis.set_major_formatter(mdates.DateFormatter("%Y-%m-%d"))
     ax.xaxis.set_major_locator(mdates.AutoDateLocator())
     ax.set_ylabel("Daily doses")
-    ax.bar(df.index[:-1], df.prima_dose[:-1], label="1st dose")
+    ax.bar(df.index[:last], df.prima_dose[:last], label="1st dose")
     ax.bar(
-        df.index[:-1], df.seconda_dose[:-1], bottom=df.prima_dose[:-1], label="2nd dose"
+        df.index[:last],
+        df.seconda_dose[:last],
+        bottom=df.prima_dose[:last],
+        label="2nd dose",
     )
     ax.plot(
-        df.index[:-1],
-        df.totale.rolling(window=7, min_periods=1, center=True).mean()[:-1],
+        df.index[:last],
+        df.totale.rolling(window=7, min_periods=1, center=True).mean()[:last],
         lw=2,
         color="ForestGreen",
         label="Total (7-days moving average)",
@@ -371,9 +710,9 @@ def plot_region(df, region_abbr):
     ax.xaxis.set_major_formatter(mdates.DateFormatter("%Y-%m-%d"))
     ax.xaxis.set_major_locator(mdates.AutoDateLocator())
     ax.set_ylabel("Total doses")
-    ax.plot(df.prima_dose.cumsum()[:-1], marker="o", label="1st dose")
-    ax.plot(df.seconda_dose.cumsum()[:-1], marker="o", label="2nd dose")
-    ax.plot(df.totale.cumsum()[:-1], marker="o", color="ForestGreen", label="Total")
+    ax.plot(df.prima_dose.cumsum()[:last], marker="o", label="1st dose")
+    ax.plot(df.seconda_dose.cumsum()[:last], marker="o", label="2nd dose")
+    ax.plot(df.totale.cumsum()[:last], marker="o", color="ForestGreen", label="Total")
     ax.legend(frameon=False, loc="best")
     fig.autofmt_xdate()
 
@@ -387,11 +726,17 @@ def main():
 
     df = load_df()
 
+    # The only writer of the archive on S3, the bot just downloads it
+    archive = Archive()
+    archive.download()
+    if archive.sync(df):
+        archive.upload()
+
     os.mkdir("charts")
     os.mkdir("charts/regions")
-    plot_daily_doses(df)
+    plot_daily_doses(archive.frame(), complete=True)
 
-    plot_cumulative(df)
+    plot_cumulative(archive.frame(), complete=True)
     plot_map(df)
 
     for region in regions: